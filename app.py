@@ -1,7 +1,11 @@
+import functools
+import hashlib
+import pickle
 import re
 from io import BytesIO
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
 import streamlit as st
 
@@ -11,6 +15,11 @@ import streamlit as st
 # Put the master pricelist Excel next to this app (or adjust the path).
 PRICE_LIST_PATH = Path("Price_LIST_Eurapo_FINAL_v3.xlsx")
 
+# Parsed pricelists are cached here, keyed by file content hash, so cold starts skip the XLSX parse.
+# Bump CACHE_VERSION whenever the cached structures change shape.
+CACHE_DIR = Path(".cache")
+CACHE_VERSION = 4
+
 # Master pricelist expected columns:
 PL_MODEL_COL = "Model"
 PL_ROWS_COL = "Cooling Rows + Heating Row"
@@ -27,67 +36,131 @@ OUT_ROWPRICE_COL = "Row Price"
 OUT_TOTAL_COL = "Total Price"
 OUT_STATUS_COL = "Match Status"
 
+# Match Status values (stored as a categorical in this order):
+MATCH_STATUSES = ["OK", "INCOMPLETE_PRICE", "NOT_FOUND"]
+
+# Whitespace runs (used on plain Python strings).
+_WS_RE = re.compile(r"\s+")
+
+# Python's \s as an explicit character class. Series.str regexes on Arrow strings run on RE2, whose \s
+# is ASCII-only; literal characters keep NBSP & co. matching on both the RE2 and Python engines.
+# Kept as a pattern string: Series.str leaves the Arrow kernels when handed a compiled pattern.
+_WS_RUN = "[ \t-\r\x1c-\x1f\x85\xa0\u1680\u2000-\u200a\u2028\u2029\u202f\u205f\u3000]+"
+
 
 # ----------------------------
 # Helpers
 # ----------------------------
-def norm_model(x) -> str:
+def _per_distinct_value(normalize):
+    """
+    Run a Series normalizer on the distinct values only and broadcast the result back.
+    Uploaded files repeat the same few models/rows many times; missing values map to "".
+    """
+
+    @functools.wraps(normalize)
+    def wrapper(s: pd.Series) -> pd.Series:
+        codes, uniques = pd.factorize(s)
+        normed = normalize(pd.Series(uniques))
+        return pd.Series(normed.array.take(codes, allow_fill=True, fill_value=""), index=s.index)
+
+    return wrapper
+
+
+@_per_distinct_value
+def norm_model(s: pd.Series) -> pd.Series:
     """
     Normalize model strings to increase match rate:
     - uppercase
     - collapse whitespace
     - replace '-' with space
     """
-    if x is None or (isinstance(x, float) and pd.isna(x)):
-        return ""
-    s = str(x).strip().upper()
-    s = s.replace("-", " ")
-    s = re.sub(r"\s+", " ", s).strip()
-    return s
+    s = s.astype("string[pyarrow]").str.strip().str.upper()
+    s = s.str.replace("-", " ", regex=False)
+    s = s.str.replace(_WS_RUN, " ", regex=True).str.strip()
+    return s.fillna("")
 
 
-def norm_rows(x) -> str:
+@_per_distinct_value
+def norm_rows(s: pd.Series) -> pd.Series:
     """
     Normalize 'Cooling Rows + Heating Row' values like '2+1R'
     - uppercase
     - remove spaces
     """
-    if x is None or (isinstance(x, float) and pd.isna(x)):
-        return ""
-    s = str(x).strip().upper()
-    s = re.sub(r"\s+", "", s)
-    return s
+    s = s.astype("string[pyarrow]").str.strip().str.upper()
+    s = s.str.replace(_WS_RUN, "", regex=True)
+    return s.fillna("")
 
 
 def _find_column(df: pd.DataFrame, wanted: str):
     """Case/space-insensitive column matcher. Returns actual column name or None."""
-    w = re.sub(r"\s+", " ", wanted.strip().lower())
+    w = _WS_RE.sub(" ", wanted.strip().lower())
     for c in df.columns:
-        cc = re.sub(r"\s+", " ", str(c).strip().lower())
+        cc = _WS_RE.sub(" ", str(c).strip().lower())
         if cc == w:
             return c
     return None
 
 
+def _pricelist_cache_paths(digest: str):
+    """Return (dataframe parquet path, lookup pickle path) for a pricelist content hash."""
+    return (
+        CACHE_DIR / f"pricelist_v{CACHE_VERSION}_{digest}.parquet",
+        CACHE_DIR / f"lookup_v{CACHE_VERSION}_{digest}.pkl",
+    )
+
+
+def _read_pricelist_cache(digest: str):
+    """Return the cached load_pricelist result for this hash, or None if absent/unreadable."""
+    df_path, lookup_path = _pricelist_cache_paths(digest)
+    if not (df_path.exists() and lookup_path.exists()):
+        return None
+    try:
+        df = pd.read_parquet(df_path)
+        with open(lookup_path, "rb") as f:
+            prices, chosen_sheet, dupes = pickle.load(f)
+    except Exception:
+        return None
+    return df, prices, chosen_sheet, dupes
+
+
+def _write_pricelist_cache(digest: str, df: pd.DataFrame, prices, chosen_sheet, dupes):
+    """Persist a load_pricelist result. Best effort: failures only cost a re-parse next time."""
+    df_path, lookup_path = _pricelist_cache_paths(digest)
+    try:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        df.to_parquet(df_path)
+        # Written last: its presence marks a complete cache entry
+        with open(lookup_path, "wb") as f:
+            pickle.dump((prices, chosen_sheet, dupes), f)
+    except Exception:
+        df_path.unlink(missing_ok=True)
+        lookup_path.unlink(missing_ok=True)
+
+
 @st.cache_data
 def load_pricelist(pricelist_path: Path):
     """
-    Loads the pricelist and builds a lookup dict keyed by (model_norm, rows_norm)
-    -> (base_price, row_price)
+    Loads the pricelist and builds a lookup table indexed by (model_norm, rows_norm)
+    with Base Price / Row Price columns.
     """
     if not pricelist_path.exists():
         raise FileNotFoundError(f"Pricelist file not found: {pricelist_path}")
 
-    xls = pd.ExcelFile(pricelist_path)
+    digest = hashlib.blake2b(pricelist_path.read_bytes(), digest_size=16).hexdigest()
+    cached = _read_pricelist_cache(digest)
+    if cached is not None:
+        return cached
 
-    required = {PL_MODEL_COL, PL_ROWS_COL, PL_BASE_COL, PL_ROWPRICE_COL}
-    chosen_sheet = None
+    xls = pd.ExcelFile(pricelist_path, engine="calamine")
 
-    for sh in xls.sheet_names:
-        preview = pd.read_excel(xls, sheet_name=sh, nrows=5)
-        if all(_find_column(preview, col) is not None for col in required):
-            chosen_sheet = sh
-            break
+    required = {PL_MODEL_COL, PL_ROWS_COL, PL_BASE_COL, PL_ROWPRICE_COL}
+    # Preview every sheet in one call against the already-open workbook
+    previews = pd.read_excel(xls, sheet_name=None, nrows=5)
+    chosen_sheet = next(
+        (sh for sh, preview in previews.items() if all(_find_column(preview, col) is not None for col in required)),
+        None,
+    )
 
     if chosen_sheet is None:
         raise ValueError(
@@ -103,34 +176,47 @@ def load_pricelist(pricelist_path: Path):
     c_base = _find_column(df, PL_BASE_COL)
     c_rowp = _find_column(df, PL_ROWPRICE_COL)
 
-    df["model_norm"] = df[c_model].apply(norm_model)
-    df["rows_norm"] = df[c_rows].apply(norm_rows)
+    df["model_norm"] = norm_model(df[c_model])
+    df["rows_norm"] = norm_rows(df[c_rows])
 
-    lookup = {}
-    dupes = []
+    keyed = (
+        df.set_index(["model_norm", "rows_norm"])[[c_base, c_rowp]]
+        .astype(float)
+        .set_axis([OUT_BASE_COL, OUT_ROWPRICE_COL], axis=1)
+    )
+
+    # Keys whose repeated rows disagree on either price (a missing price counts as a value)
+    n_prices = keyed.groupby(level=["model_norm", "rows_norm"]).nunique(dropna=False)
+    dupes = list(n_prices.index[(n_prices > 1).any(axis=1)])
+
+    # Last seen value wins; the MultiIndex lets price_input_df resolve every row in one reindex
+    prices = keyed[~keyed.index.duplicated(keep="last")]
+
+    _write_pricelist_cache(digest, df, prices, chosen_sheet, dupes)
+    return df, prices, chosen_sheet, dupes
 
-    for _, row in df.iterrows():
-        key = (row["model_norm"], row["rows_norm"])
-        base = float(row[c_base]) if pd.notna(row[c_base]) else None
-        rowp = float(row[c_rowp]) if pd.notna(row[c_rowp]) else None
 
-        if key in lookup and lookup[key] != (base, rowp):
-            dupes.append((key, lookup[key], (base, rowp)))
-        lookup[key] = (base, rowp)
+# Bounded: the cache is shared by all sessions, so keep only a few recent uploads and expire them.
+@st.cache_data(max_entries=8, ttl=3600)
+def read_uploaded_excel(data: bytes) -> pd.DataFrame:
+    """Parse uploaded XLSX bytes. Cached on the content, so reruns don't re-parse the same upload."""
+    return pd.read_excel(BytesIO(data), engine="calamine")
 
-    return df, lookup, chosen_sheet, dupes
 
+def _level_codes(values: pd.Series, level: pd.Index) -> np.ndarray:
+    """Position of each value in level (-1 if absent), hashing each distinct value only once."""
+    codes, uniques = pd.factorize(values)
+    return level.get_indexer(uniques).astype(np.int64)[codes]
 
-def price_input_df(input_df: pd.DataFrame, lookup: dict):
+
+def price_input_df(input_df: pd.DataFrame, prices: pd.DataFrame):
     """
     Adds Base Price, Row Price, Total Price (= Base + Row), and Match Status columns
     by matching (Model, Cooling Rows + Heating Row).
     """
-    df = input_df.copy()
-
     # Resolve input columns (case/space-insensitive)
-    c_model = _find_column(df, IN_MODEL_COL)
-    c_rows = _find_column(df, IN_ROWS_COL)
+    c_model = _find_column(input_df, IN_MODEL_COL)
+    c_rows = _find_column(input_df, IN_ROWS_COL)
 
     missing = []
     if c_model is None:
@@ -143,42 +229,50 @@ def price_input_df(input_df: pd.DataFrame, lookup: dict):
             f"Required columns (exact names preferred): ['{IN_MODEL_COL}', '{IN_ROWS_COL}']"
         )
 
-    df["_model_norm"] = df[c_model].apply(norm_model)
-    df["_rows_norm"] = df[c_rows].apply(norm_rows)
-
-    base_out, rowp_out, total_out, status = [], [], [], []
-
-    for m, r in zip(df["_model_norm"], df["_rows_norm"]):
-        val = lookup.get((m, r))
-        if val is None or val == (None, None):
-            base_out.append(None)
-            rowp_out.append(None)
-            total_out.append(None)
-            status.append("NOT_FOUND")
-        else:
-            base, rowp = val
-            base_out.append(base)
-            rowp_out.append(rowp)
-            if base is None or rowp is None:
-                total_out.append(None)
-                status.append("INCOMPLETE_PRICE")
-            else:
-                total_out.append(float(base) + float(rowp))
-                status.append("OK")
-
-    df[OUT_BASE_COL] = base_out
-    df[OUT_ROWPRICE_COL] = rowp_out
-    df[OUT_TOTAL_COL] = total_out
-    df[OUT_STATUS_COL] = status
-
-    df = df.drop(columns=["_model_norm", "_rows_norm"], errors="ignore")
-    return df
+    # Factorize input keys against the lookup's MultiIndex levels, then read prices from a dense
+    # (model x rows) grid: slot = model_code * n_rows + rows_code, a plain array gather per column.
+    levels, codes = prices.index.levels, prices.index.codes
+    n_rows = len(levels[1])
+    n_slots = len(levels[0]) * n_rows
+
+    # One extra trailing NaN slot for keys that aren't in the pricelist
+    base_grid = np.full(n_slots + 1, np.nan)
+    rowp_grid = np.full(n_slots + 1, np.nan)
+    pl_slots = codes[0].astype(np.int64) * n_rows + codes[1]
+    base_grid[pl_slots] = prices[OUT_BASE_COL].to_numpy(dtype=float)
+    rowp_grid[pl_slots] = prices[OUT_ROWPRICE_COL].to_numpy(dtype=float)
+
+    model_codes = _level_codes(norm_model(input_df[c_model]), levels[0])
+    rows_codes = _level_codes(norm_rows(input_df[c_rows]), levels[1])
+    slots = model_codes * n_rows + rows_codes
+    slots[(model_codes < 0) | (rows_codes < 0)] = n_slots
+
+    base = base_grid[slots]
+    rowp = rowp_grid[slots]
+
+    base_na = np.isnan(base)
+    rowp_na = np.isnan(rowp)
+
+    # Index into MATCH_STATUSES: 0 = both prices, 1 = exactly one missing, 2 = both missing
+    status_codes = (base_na ^ rowp_na).astype(np.int8) + 2 * (base_na & rowp_na).astype(np.int8)
+
+    # One new frame with the output columns; input_df itself is left untouched
+    return input_df.assign(
+        **{
+            OUT_BASE_COL: base,
+            OUT_ROWPRICE_COL: rowp,
+            OUT_TOTAL_COL: base + rowp,
+            OUT_STATUS_COL: pd.Categorical.from_codes(status_codes, categories=MATCH_STATUSES),
+        }
+    )
 
 
 def to_excel_bytes(df: pd.DataFrame, sheet_name: str = "PRICED") -> bytes:
     """Convert DataFrame to Excel bytes."""
     bio = BytesIO()
-    with pd.ExcelWriter(bio, engine="openpyxl") as writer:
+    # xlsxwriter's constant_memory mode can't be used: pandas emits cells column by column,
+    # and constant_memory only keeps the current row, silently dropping earlier ones.
+    with pd.ExcelWriter(bio, engine="xlsxwriter") as writer:
         df.to_excel(writer, index=False, sheet_name=sheet_name)
     bio.seek(0)
     return bio.getvalue()
@@ -198,7 +292,10 @@ st.caption(
 
 # Load pricelist
 try:
-    pl_df, lookup, sheet, dupes = load_pricelist(PRICE_LIST_PATH)
+    # Kept per session so widget reruns skip even the st.cache_data argument hashing
+    if "pricelist" not in st.session_state:
+        st.session_state["pricelist"] = load_pricelist(PRICE_LIST_PATH)
+    pl_df, prices, sheet, dupes = st.session_state["pricelist"]
     st.success(f"Loaded pricelist: {PRICE_LIST_PATH.name} | Sheet: {sheet} | Rows: {len(pl_df)}")
     if dupes:
         st.warning(
@@ -217,14 +314,14 @@ uploaded = st.file_uploader("Upload your Excel (XLSX)", type=["xlsx"])
 if uploaded:
     # Read input
     try:
-        in_df = pd.read_excel(uploaded)
+        in_df = read_uploaded_excel(uploaded.getvalue())
     except Exception as e:
         st.error(f"Could not read uploaded file as Excel: {e}")
         st.stop()
 
     # Price it
     try:
-        out_df = price_input_df(in_df, lookup)
+        out_df = price_input_df(in_df, prices)
     except Exception as e:
         st.error(str(e))
         st.stop()
@@ -242,9 +339,11 @@ if uploaded:
 
     with right:
         total = len(out_df)
-        ok = int((out_df[OUT_STATUS_COL] == "OK").sum()) if OUT_STATUS_COL in out_df.columns else 0
-        nf = int((out_df[OUT_STATUS_COL] == "NOT_FOUND").sum()) if OUT_STATUS_COL in out_df.columns else 0
-        inc = int((out_df[OUT_STATUS_COL] == "INCOMPLETE_PRICE").sum()) if OUT_STATUS_COL in out_df.columns else 0
+        # Single pass over the (categorical) status column for all three counts
+        counts = out_df[OUT_STATUS_COL].value_counts() if OUT_STATUS_COL in out_df.columns else {}
+        ok = int(counts.get("OK", 0))
+        nf = int(counts.get("NOT_FOUND", 0))
+        inc = int(counts.get("INCOMPLETE_PRICE", 0))
 
         st.subheader("Match summary")
         st.write(f"Total rows: **{total}**")
@@ -260,11 +359,10 @@ if uploaded:
             show_cols = [c for c in [c_model, c_rows, OUT_STATUS_COL] if c in out_df.columns]
             st.dataframe(out_df[out_df[OUT_STATUS_COL] == "NOT_FOUND"][show_cols].head(30))
 
-    # Download output Excel
-    excel_bytes = to_excel_bytes(out_df, sheet_name="PRICED")
+    # Download output Excel (built only when the button is clicked, not on every rerun)
     st.download_button(
         label="Download priced Excel",
-        data=excel_bytes,
+        data=lambda: to_excel_bytes(out_df, sheet_name="PRICED"),
         file_name="priced_output.xlsx",
         mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
     )